@@ -7,11 +7,37 @@ This API defines the interface to PubMED.
 Author: Lorenz Hexemer
 """
 
-import re
-import requests as http
-from bs4 import BeautifulSoup as html
+import threading
+from io import BytesIO
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from lxml import etree, html
 from typing import Optional, Generator
 
+from .PubMedClient import PubMedClient, EUTILS_URL
+
+
+def _docsum_xpath(authors_span: str) -> etree.XPath:
+    """
+    Compiles the XPath selecting the title, author and citation nodes of
+    the document summaries on a PubMed results page in document order.
+    """
+    return etree.XPath(
+        "//*[self::a[contains(@class, 'docsum-title')]"
+        f" or self::span[{authors_span}]"
+        " or self::span[contains(@class, 'docsum-journal-citation')]]"
+    )
+
+
+_SEL_RESULTS_AMOUNT = etree.XPath(
+    "string(//div[contains(@class, 'results-amount')]/h3/span)"
+)
+_SEL_DOCSUMS = _docsum_xpath("contains(@class, 'docsum-authors')")
+_SEL_DOCSUMS_LONG_AUTHORS = _docsum_xpath(
+    "contains(@class, 'docsum-authors')"
+    " and not(contains(@class, 'short-authors'))"
+)
+
 
 class PubMedArticle:
     """
@@ -23,16 +49,25 @@ class PubMedArticle:
         authors (Optional[str]): The authors of the article.
         publication (Optional[str]): The publication where the article
             was published.
-        doc (Optional[str]): The HTML content of the article page.
         abstract (Optional[str]): The abstract of the article.
         fulltext_link (Optional[str]): The link to the full text
             of the article.
     """
+    # whether citing articles are listed with the short author spans
+    _wants_short_authors = True
+    # parsed citation pages by (pmid, page, short_authors), least recently
+    # used first; shared between articles and bounded to citing_cache_size.
+    # Only plain records are kept, so no session outlives its client.
+    citing_cache_size = 1024
+    _citing_cache = OrderedDict()
+    _citing_lock = threading.Lock()
+
     def __init__(self, id: str,
                  title: Optional[str] = None,
                  authors_long: Optional[str] = None,
                  authors_short: Optional[str] = None,
-                 publication: Optional[str] = None
+                 publication: Optional[str] = None,
+                 client: Optional[PubMedClient] = None
                  ) -> None:
         """
         Initializes a new instance of the PubMedArticle class.
@@ -44,11 +79,30 @@ class PubMedArticle:
               Defaults to None.
             publication (Optional[str], optional): The publication where the
               article was published. Defaults to None.
+            client (Optional[PubMedClient], optional): The client used for
+              requests. Defaults to the shared default client.
         """
         self.id = id
+        self.client = client if client is not None else PubMedClient.default()
         if title is not None:
             self.setMetaData(title, authors_long, authors_short, publication)
 
+    def __getstate__(self) -> dict:
+        """
+        Returns the state for pickling without the client, which holds a
+        session and a lock.
+        """
+        state = self.__dict__.copy()
+        del state['client']
+        return state
+
+    def __setstate__(self, state: dict) -> None:
+        """
+        Restores a pickled article, which uses the default client.
+        """
+        self.__dict__.update(state)
+        self.client = PubMedClient.default()
+
     def setMetaData(self,
                     title: str,
                     authors_long: str,
@@ -65,7 +119,9 @@ class PubMedArticle:
         """
         self.title = title.strip()
         self.authors_long = authors_long.strip()
-        self.authors_short = authors_short.strip()
+        self.authors_short = (
+            authors_short.strip() if authors_short is not None else None
+        )
         self.publication = publication.strip()
 
     def __str__(self) -> str:
@@ -77,7 +133,7 @@ class PubMedArticle:
         """
         if hasattr(self, "title"):
             return (
-                f"{self.authors_short} {self.title}"
+                f"{self.authors_short or self.authors_long} {self.title}"
                 f" {self.publication} PMID {self.id}"
             )
         else:
@@ -85,73 +141,240 @@ class PubMedArticle:
 
     def load(self) -> None:
         """
-        Loads the article details from PubMed using its ID.
+        Loads the article details from the E-utilities EFetch endpoint.
         """
-        response = http.get(f'https://pubmed.ncbi.nlm.nih.gov/{self.id}/')
-        self.doc = html(response.text, "html.parser")
-        self.abstract = self.doc.find('div', class_="abstract-content")
-        if self.abstract is not None:
-            self.abstract = re.sub("\n+", "\n", self.abstract.text.strip())
-        if not hasattr(self, "title"):
-            self.loadMetaData()
-        pmc_link = self.doc.find("a", title="Free full text at PubMed Central")
-        self.fulltext_link = None
-        if pmc_link is not None:
-            self.fulltext_link = pmc_link.attrs['href']
+        response = self.client.sendRequest(
+            'GET',
+            f'{EUTILS_URL}/efetch.fcgi',
+            params={'db': 'pubmed', 'id': self.id, 'retmode': 'xml',
+                    **self.client.params}
+        )
+        found = False
+        for elem in self.iterXml(BytesIO(response.content)):
+            self.loadXml(elem)
+            found = True
+        if not found:
+            raise Exception(f'No PubMed record found for PMID {self.id}')
 
-    def loadMetaData(self) -> None:
+    @staticmethod
+    def iterXml(source) -> Generator:
         """
-        Loads metadata from the document.
+        Incrementally parses an EFetch response. Each <PubmedArticle> is
+        dropped from the tree once the consumer is done with it, so memory
+        stays flat regardless of the number of articles.
+
+        Args:
+            source: File-like object providing the XML bytes.
+
+        Yields:
+            The <PubmedArticle> elements.
         """
-        title = self.doc.find('h1', class_="heading-title").text
-        button_id = "full-view-journal-trigger"
-        journal = self.doc.find('button', id=button_id).text.strip()
-        issue = self.doc.find('span', class_="cit").text.strip()
-        publication = f"{journal}. {issue}"
+        for _, elem in etree.iterparse(source, tag="PubmedArticle"):
+            yield elem
+            elem.clear()
+            while elem.getprevious() is not None:
+                del elem.getparent()[0]
+
+    @classmethod
+    def fromXml(cls,
+                elem: etree._Element,
+                client: Optional[PubMedClient] = None
+                ) -> 'PubMedArticle':
+        """
+        Creates an article from a <PubmedArticle> element of an
+        EFetch response.
+
+        Args:
+            elem: The <PubmedArticle> element.
+            client: The client used for further requests of the article.
+
+        Returns:
+            The loaded article.
+        """
+        article = cls(elem.findtext('MedlineCitation/PMID'), client=client)
+        article.loadXml(elem)
+        return article
+
+    def loadXml(self, elem: etree._Element) -> None:
+        """
+        Loads metadata, abstract and full text link from a
+        <PubmedArticle> element of an EFetch response.
+
+        Args:
+            elem: The <PubmedArticle> element.
+        """
+        article = elem.find('MedlineCitation/Article')
+        title = _text(article.find('ArticleTitle'))
+
+        names = []
+        for author in article.iterfind('AuthorList/Author'):
+            name = (author.findtext('LastName')
+                    or author.findtext('CollectiveName'))
+            initials = author.findtext('Initials')
+            if name and initials:
+                name += f" {initials}"
+            if name:
+                names.append(name)
+        authors_long = ', '.join(names) + "." if names else ""
+        authors_short = names[0] if names else ""
+        if len(names) > 1:
+            authors_short += ", et al."
 
-        authors = self.doc.find('div', class_="authors-list").text
-        authors = re.sub(r"(\d\s)+", "", authors)
-        authors = re.sub(r"\s+", " ", authors)
-        authors = ', '.join(
-            [re.sub("([A-Z])[^ ]+ ([^ ]) ([^ ]+)", "\\3 \\1\\2", a).strip()
-             for a in authors.split(',')]) + "."
+        journal = article.findtext('Journal/Title', '')
+        issue = article.find('Journal/JournalIssue')
+        year = (issue.findtext('PubDate/Year')
+                or issue.findtext('PubDate/MedlineDate', ''))
+        volume = issue.findtext('Volume')
+        number = issue.findtext('Issue')
+        pages = article.findtext('Pagination/MedlinePgn')
+        publication = f"{journal}. {year}"
+        if volume:
+            publication += f";{volume}"
+        if number:
+            publication += f"({number})"
+        if pages:
+            publication += f":{pages}"
+        publication += "."
 
-        self.setMetaData(
-            title, authors_long=authors, publication=publication
+        self.setMetaData(title, authors_long, authors_short, publication)
+
+        sections = []
+        for section in article.iterfind('Abstract/AbstractText'):
+            label = section.get('Label')
+            text = _text(section)
+            sections.append(f"{label}: {text}" if label else text)
+        self.abstract = '\n'.join(sections) if sections else None
+
+        pmc_id = elem.findtext(
+            "PubmedData/ArticleIdList/ArticleId[@IdType='pmc']"
         )
+        self.fulltext_link = None
+        if pmc_id is not None:
+            self.fulltext_link = (
+                f"https://www.ncbi.nlm.nih.gov/pmc/articles/{pmc_id}/"
+            )
 
-    def articles_citing(self, limit: int = 100) -> Generator:
+    def articles_citing(self,
+                        limit: int = 100,
+                        short_authors: bool = True
+                        ) -> Generator:
         """
         Yields articles citing the current document up to the given limit.
 
         Args:
             limit: Maximum number of articles to yield.
+            short_authors: Whether to extract the short author lists
+                of the citing articles as well.
 
         Yields:
             Article citations.
         """
-        self.citing_page = 1
+        self._wants_short_authors = short_authors
+        self.citations = []
+        self.citing_page = 0
         self.grepMoreResults()
-        for at in range(self.n_citations):
-            if at == limit:
-                break
 
-            if at == len(self.citations):
-                self.grepMoreResults()
-            yield self.citations[at]
+        # the next page is fetched in the background while the current
+        # one is consumed; at most one page is prefetched at a time
+        pool = ThreadPoolExecutor(1)
+        prefetch = None
+        try:
+            for at in range(min(self.n_citations, limit)):
+                if at == len(self.citations):
+                    if prefetch is not None:
+                        prefetch.result()
+                        prefetch = None
+                    self.grepMoreResults()
+                    if at == len(self.citations):
+                        break
+
+                if (prefetch is None
+                        and len(self.citations) < min(self.n_citations,
+                                                      limit)):
+                    prefetch = pool.submit(
+                        self._fetch_citation_page, self.citing_page + 1
+                    )
+                yield self.citations[at]
+        finally:
+            pool.shutdown(wait=False, cancel_futures=True)
 
     def grepMoreResults(self) -> None:
         """
-        Fetches more results from the PubMed website.
+        Fetches the next page of citing articles from the PubMed website.
+        Pages prefetched by articles_citing are taken from the page cache.
         """
         self.citing_page += 1
+        self.n_citations, citations = self._fetch_citation_page(
+            self.citing_page
+        )
+        self.citations += citations
+
+    def _fetch_citation_page(self, page: int) -> tuple:
+        """
+        Fetches and parses one page of articles citing this article.
+        Parsed pages are kept in a bounded cache, so iterating the
+        citations of an article again does not download them again.
+        Failed requests raise and are not cached.
+
+        Args:
+            page: Number of the results page.
+
+        Returns:
+            Total number of citing articles and a list of the citing
+            articles on the page.
+        """
+        key = (self.id, page, self._wants_short_authors)
+        with self._citing_lock:
+            cached = self._citing_cache.get(key)
+            if cached is not None:
+                self._citing_cache.move_to_end(key)
+        if cached is None:
+            cached = self._download_citation_page(page)
+            with self._citing_lock:
+                self._citing_cache[key] = cached
+                while len(self._citing_cache) > self.citing_cache_size:
+                    self._citing_cache.popitem(last=False)
+
+        n_citations, records = cached
+        return n_citations, [
+            PubMedArticle(*record, client=self.client) for record in records
+        ]
+
+    def _download_citation_page(self, page: int) -> tuple:
+        """
+        Downloads one page of articles citing this article.
+
+        Args:
+            page: Number of the results page.
+
+        Returns:
+            Total number of citing articles and a tuple of the
+            (id, title, authors_long, authors_short, publication)
+            records of the citing articles on the page.
+        """
         link = (
             f'https://pubmed.ncbi.nlm.nih.gov/?linkname=pubmed_pubmed_citedin&'
-            f'from_uid={self.id}&page={self.citing_page}'
+            f'from_uid={self.id}&page={page}'
+        )
+        response = self.client.sendRequest('GET', link)
+        # parse the raw bytes instead of decoding response.text, which may
+        # run charset detection. A charset sent by the server wins, without
+        # one lxml follows the page's <meta charset>; requests' ISO-8859-1
+        # fallback for text/html must not override the latter.
+        parser = None
+        if 'charset' in response.headers.get('Content-Type', '').lower():
+            parser = html.HTMLParser(encoding=response.encoding)
+        doc = html.fromstring(response.content, parser=parser)
+        records = tuple(
+            (article.id, article.title, article.authors_long,
+             article.authors_short, article.publication)
+            for article in self.extractRefferings(doc)
         )
-        response = http.get(link)
-        doc = html(response.text, "html.parser")
-        self.citing += self.extractRefferings(doc)
+
+        n_citations = _SEL_RESULTS_AMOUNT(doc).replace(',', '').strip()
+        if n_citations.isdigit():
+            return int(n_citations), records
+        return len(records), records
 
     def extractRefferings(self, doc) -> list:
         """
@@ -163,23 +386,38 @@ class PubMedArticle:
         Returns:
             List of extracted references.
         """
-        page_links = doc.find_all('a', class_="docsum-title")
-        pubmed_ids = [p.attrs['data-article-id'] for p in page_links]
-        titles = [p.text for p in page_links]
-        class_name = "docsum-authors"
-        authors_long = [
-            s.text for s in doc.find_all('span', class_=class_name)
-        ]
-        class_name = "docsum-journal-citation"
-        citations = [c.text for c in doc.find_all('span', class_=class_name)]
-
-        results = [
-            PubMedArticle(*args)
-            for args in zip(
-                pubmed_ids,
-                titles,
-                authors_long=authors_long,
-                citations=citations
-            )
-        ]
+        if self._wants_short_authors:
+            select_docsums = _SEL_DOCSUMS
+        else:
+            select_docsums = _SEL_DOCSUMS_LONG_AUTHORS
+
+        results, record = [], None
+        for elem in select_docsums(doc):
+            if elem.tag == 'a':
+                record = [elem.get('data-article-id'), elem.text_content()]
+            elif record is None:
+                continue
+            elif 'docsum-authors' in elem.get('class'):
+                record.append(elem.text_content())
+            else:
+                pmid, title, *authors = record
+                results.append(PubMedArticle(
+                    pmid,
+                    title,
+                    authors[0] if authors else "",
+                    authors[1] if len(authors) > 1 else None,
+                    elem.text_content(),
+                    client=self.client
+                ))
+                record = None
         return results
+
+
+def _text(elem: Optional[etree._Element]) -> str:
+    """
+    Returns the whitespace normalized text of an XML element including
+    inline markup such as <i> or <sup>.
+    """
+    if elem is None:
+        return ""
+    return " ".join("".join(elem.itertext()).split())
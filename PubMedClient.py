@@ -0,0 +1,151 @@
+"""
+PubMEDapi
+~~~~~~~~~~~~~~~~
+
+This API defines the interface to PubMED.
+
+Author: Lorenz Hexemer
+"""
+import time
+import threading
+from typing import Optional
+import requests as http
+from tenacity import (
+    retry, retry_if_exception, stop_after_attempt, wait_exponential_jitter
+)
+
+EUTILS_URL = "https://eutils.ncbi.nlm.nih.gov/entrez/eutils"
+# NCBI asks E-utilities clients to identify themselves; set 'email' to a
+# contact address. Parameters set to None are dropped by requests.
+EUTILS_PARAMS = {'tool': 'PubMedApi', 'email': None}
+
+RETRY_STATUS_CODES = (429, 500, 502, 503)
+# seconds to wait for a connection and between bytes of the response
+TIMEOUT = (5, 60)
+
+
+def _is_transient(error: BaseException) -> bool:
+    """
+    Tells whether a failed request is worth retrying.
+    """
+    if isinstance(error, http.HTTPError):
+        return error.response.status_code in RETRY_STATUS_CODES
+    return isinstance(error, (http.ConnectionError, http.Timeout))
+
+
+class RateLimiter:
+    """
+    Spaces out calls so that no more than rate calls per second are
+    started, shared between all threads using the limiter.
+    """
+    def __init__(self, rate: float) -> None:
+        """
+        Initializes a RateLimiter object.
+
+        Args:
+            rate: Maximum number of calls per second.
+        """
+        self.interval = 1 / rate
+        self.next_call = 0.0
+        self.lock = threading.Lock()
+
+    def wait(self) -> None:
+        """
+        Blocks until the next call is allowed.
+        """
+        with self.lock:
+            now = time.monotonic()
+            delay = self.next_call - now
+            self.next_call = max(now, self.next_call) + self.interval
+        if delay > 0:
+            time.sleep(delay)
+
+
+class PubMedClient:
+    """
+    Sends the requests of searches and articles to PubMed.
+
+    Attributes:
+        session (http.Session): The session used for requests.
+        params (dict): Parameters sent with every E-utilities request.
+        max_workers (int): Number of requests allowed per second, which
+            is also used as the number of concurrent requests.
+    """
+    _default = None
+    # NCBI enforces its rate limit per IP address or API key, so all
+    # clients with the same API key share one limiter
+    _limiters = {}
+    _limiters_lock = threading.Lock()
+
+    def __init__(self,
+                 session: Optional[http.Session] = None,
+                 api_key: Optional[str] = None,
+                 tool: Optional[str] = None,
+                 email: Optional[str] = None
+                 ) -> None:
+        """
+        Initializes a PubMedClient object.
+
+        Args:
+            session: The session used for requests, e.g. a cached session.
+                Defaults to a new requests session.
+            api_key: NCBI API key, raises the rate limit from 3 to 10
+                requests per second.
+            tool: Name of the application reported to NCBI.
+            email: Contact address reported to NCBI.
+        """
+        self.session = session if session is not None else http.Session()
+        self.params = {**EUTILS_PARAMS}
+        for name, value in [('api_key', api_key),
+                            ('tool', tool),
+                            ('email', email)]:
+            if value is not None:
+                self.params[name] = value
+        # NCBI allows 3 requests per second, 10 with an API key
+        self.max_workers = 10 if self.params.get('api_key') else 3
+        with self._limiters_lock:
+            key = self.params.get('api_key')
+            if key not in self._limiters:
+                self._limiters[key] = RateLimiter(self.max_workers)
+            self.rate_limiter = self._limiters[key]
+
+    @classmethod
+    def default(cls) -> 'PubMedClient':
+        """
+        Returns the client shared by all objects created without one.
+
+        Returns:
+            The default client.
+        """
+        if cls._default is None:
+            cls._default = cls()
+        return cls._default
+
+    @retry(stop=stop_after_attempt(5),
+           wait=wait_exponential_jitter(initial=1, max=30),
+           retry=retry_if_exception(_is_transient),
+           reraise=True)
+    def sendRequest(self, method: str, url: str, **kwargs) -> http.Response:
+        """
+        Sends a rate limited request. Transient failures are retried with
+        exponential backoff, other failures raise an HTTPError.
+
+        Args:
+            method: HTTP method of the request.
+            url: URL of the request.
+            **kwargs: Further arguments for requests.Session.request.
+                The timeout defaults to TIMEOUT.
+
+        Returns:
+            The successful response.
+        """
+        kwargs.setdefault('timeout', TIMEOUT)
+        self.rate_limiter.wait()
+        response = self.session.request(method, url, **kwargs)
+        try:
+            response.raise_for_status()
+        except http.HTTPError:
+            # release the connection of a streamed response before retrying
+            response.close()
+            raise
+        return response
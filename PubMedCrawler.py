@@ -7,35 +7,113 @@ This API defines the interface to PubMED.
 Author: Lorenz Hexemer
 """
 import os
-import dill
+import mmap
+import pickle
+import sqlite3
+import zstandard
+import requests as http
+import requests_cache
+from requests_cache import EXPIRE_IMMEDIATELY
+from datetime import timedelta
 from typing import Optional
 
+from .PubMedClient import PubMedClient
 from .PubMedArticle import PubMedArticle
 from .PubMedSearch import PubMedSearch
 
 
 class PubMedCrawler:
-    def __init__(self, path: Optional[str] = None) -> None:
+    # runtime resources that are recreated instead of saved
+    transient_vars = ('session', 'client', '_db', '_pending',
+                      '_text_fp', '_index_fp')
+    # number of archive writes collected per transaction
+    commit_every = 100
+    _cctx = zstandard.ZstdCompressor(level=3)
+
+    def __init__(self,
+                 path: Optional[str] = None,
+                 api_key: Optional[str] = None,
+                 tool: Optional[str] = None,
+                 email: Optional[str] = None
+                 ) -> None:
         """
         Initializes a PubMedCrawler object.
 
         Args:
             path (Optional[str]): The path to the archive directory.
+            api_key (Optional[str]): NCBI API key, raises the rate limit
+                from 3 to 10 requests per second.
+            tool (Optional[str]): Name of the application reported to NCBI.
+            email (Optional[str]): Contact address reported to NCBI.
         """
         self.results = {}
+        self.client_args = {'api_key': api_key, 'tool': tool, 'email': email}
+        self.session = http.Session()
+        self.client = PubMedClient(self.session, **self.client_args)
+        self._db = None
+        self._pending = 0
+        self._text_fp = None
+        self._index_fp = None
         if path is not None:
             self.setArchivePath(path)
 
     def setArchivePath(self, path: str) -> None:
         """
         Sets the archive path and creates the directory if it doesn't exist.
+        HTTP responses are cached in the archive from then on and the
+        metadata is stored in its archive.db.
 
         Args:
             path (str): The path to the archive directory.
         """
+        self.close()
         self.archivepath = path
         if not os.path.isdir(path):
             os.mkdir(path)
+        self.session = requests_cache.CachedSession(
+            cache_name=f"{path}/.httpcache",
+            backend="sqlite",
+            expire_after=timedelta(days=30),
+            # article records hardly ever change, search results are
+            # revalidated on every request so polls see new articles and
+            # citing articles are added daily
+            urls_expire_after={
+                '*/esearch.fcgi': EXPIRE_IMMEDIATELY,
+                'pubmed.ncbi.nlm.nih.gov/?linkname=*': timedelta(days=1)
+            },
+            allowable_methods=('GET', 'HEAD', 'POST')
+        )
+        self.client = PubMedClient(self.session, **self.client_args)
+        self.connect()
+
+    def connect(self) -> sqlite3.Connection:
+        """
+        Returns the connection to the archive database. It is opened on
+        first use, so a crawler keeps working after close().
+
+        Returns:
+            sqlite3.Connection: The connection to archive.db.
+        """
+        if self._db is not None:
+            return self._db
+        self._db = sqlite3.connect(f"{self.archivepath}/archive.db")
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS articles("
+            "id TEXT PRIMARY KEY, title TEXT, authors TEXT, citation TEXT)"
+        )
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS found_by("
+            "pmid TEXT, search_str TEXT, PRIMARY KEY(pmid, search_str))"
+        )
+        # archives created before found_by had a key need an index to
+        # look up the searches of an article
+        self._db.execute(
+            "CREATE INDEX IF NOT EXISTS found_by_pmid ON found_by(pmid)"
+        )
+        self._db.commit()
+        return self._db
 
     def searchFor(self,
                   search_str: str,
@@ -53,17 +131,29 @@ class PubMedCrawler:
             not_older_than (bool): Whether to filter articles based on age.
             abstract_available (bool): Whether to filter for articles
                 with abstracts or not.
-            **kwargs: Additional keyword arguments.
+            **kwargs: Additional keyword arguments for PubMedSearch.
         """
         search_str = search_str.replace(' ', '+')
         search_results = PubMedSearch(search_str,
                                       not_older_than=not_older_than,
                                       abstract_available=abstract_available,
+                                      client=self.client,
                                       **kwargs
                                       )
-        for article in search_results.scan_results(limit):
+        new = []
+        for pmids in search_results.scan_ids(limit):
+            for pmid in pmids:
+                if pmid in self.results or self.loadParsed(pmid):
+                    self.addFoundBy(PubMedArticle(pmid, client=self.client),
+                                    search_str)
+                else:
+                    new.append(pmid)
+
+        for article in search_results.fetch_details(new):
             self.addArticle(article)
             self.addFoundBy(article, search_str)
+        if hasattr(self, 'archivepath'):
+            self.commitMeta()
 
     def addArticle(self, article: PubMedArticle) -> None:
         """
@@ -77,8 +167,11 @@ class PubMedCrawler:
         """
         if article.id in self.results.keys():
             return False
+        if self.loadParsed(article.id):
+            return True
 
-        article.load()
+        if not hasattr(article, 'abstract'):
+            article.load()
         if hasattr(self, 'archivepath') and article.abstract is not None:
             self.saveText(article.id, article.abstract)
         info = {
@@ -96,29 +189,102 @@ class PubMedCrawler:
 
         return True
 
+    def loadParsed(self, article_id: int) -> bool:
+        """
+        Restores the parsed information of an article from the archive
+        database and its abstract from the abstract archive.
+
+        Args:
+            article_id (int): The ID of the article.
+
+        Returns:
+            bool: True if the article was found in the archive.
+        """
+        if not hasattr(self, 'archivepath'):
+            return False
+        db = self.connect()
+        row = db.execute(
+            "SELECT title, authors, citation FROM articles WHERE id = ?",
+            (article_id,)
+        ).fetchone()
+        if row is None:
+            return False
+        found_by = db.execute(
+            "SELECT search_str FROM found_by WHERE pmid = ?", (article_id,)
+        )
+        self.results[article_id] = {
+            'id': article_id,
+            'title': row[0],
+            'authors': row[1],
+            'citation': row[2],
+            'found_by': [search_str for search_str, in found_by],
+            'abstract': self.loadText(article_id)
+        }
+        return True
+
     def saveText(self, article_id: int, abstract: str) -> None:
         """
-        Saves the abstract text of an article to a file.
+        Appends the abstract text of an article as a separate zstd frame
+        to abstracts.zst and records its position in abstracts.index.
 
         Args:
             article_id (int): The ID of the article.
             abstract (str): The abstract text.
         """
-        with open(f"{self.archivepath}/{article_id}.txt", 'w') as fp:
-            fp.write(abstract)
+        if self._text_fp is None:
+            self._text_fp = open(f"{self.archivepath}/abstracts.zst", 'ab')
+            self._index_fp = open(f"{self.archivepath}/abstracts.index", 'a')
+        frame = self._cctx.compress(abstract.encode())
+        offset = self._text_fp.tell()
+        self._text_fp.write(frame)
+        self._index_fp.write(f"{article_id}\t{offset}\t{len(frame)}\n")
+
+    def loadText(self, article_id: int) -> Optional[str]:
+        """
+        Loads the abstract text of an article from the archive.
+
+        Args:
+            article_id (int): The ID of the article.
+
+        Returns:
+            Optional[str]: The abstract text, None if it is not archived.
+        """
+        if not hasattr(self, 'archivepath'):
+            return None
+        if self._text_fp is not None:
+            self._text_fp.flush()
+            self._index_fp.flush()
+        index_name = f"{self.archivepath}/abstracts.index"
+        if not os.path.isfile(index_name) or not os.path.getsize(index_name):
+            return None
+
+        key = f"\n{article_id}\t".encode()
+        with open(index_name, 'rb') as fp, \
+                mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ) as index:
+            start = index.rfind(key) + 1
+            if not start and index[:len(key) - 1] != key[1:]:
+                return None
+            end = index.find(b"\n", start)
+            _, offset, length = index[start:end].split(b"\t")
+
+        with open(f"{self.archivepath}/abstracts.zst", 'rb') as fp:
+            fp.seek(int(offset))
+            frame = fp.read(int(length))
+        return zstandard.ZstdDecompressor().decompress(frame).decode()
 
     def saveMeta(self, article_id: int, info: dict) -> None:
         """
-        Saves the metadata of an article to a file.
+        Saves the metadata of an article to the archive database.
 
         Args:
             article_id (int): The ID of the article.
             info (Dict): The metadata information.
         """
-        with open(f"{self.archivepath}/{article_id}.meta", 'w') as fp:
-            for label, value in info.items():
-                value = '' if value == [] else value + "\n"
-                fp.write(f"{label}: {value}")
+        self.writeMeta(
+            "INSERT OR REPLACE INTO articles(id, title, authors, citation)"
+            " VALUES(?, ?, ?, ?)",
+            (article_id, info['title'], info['authors'], info['citation'])
+        )
 
     def addFoundBy(self, article: PubMedArticle, search_str: str) -> None:
         """
@@ -128,20 +294,77 @@ class PubMedCrawler:
             article (PubMedArticle): The article to update.
             search_str (str): The search string.
         """
-        self.results[article.id]['found_by'].append(search_str)
+        found_by = self.results[article.id]['found_by']
+        if search_str in found_by:
+            return
+        found_by.append(search_str)
         if hasattr(self, 'archivepath'):
             self.saveFoundBy(article.id, search_str)
 
     def saveFoundBy(self, article_id: int, search_str: str) -> None:
         """
-        Appends a search string to the metadata file of an article.
+        Saves a search string that found an article to the archive database.
 
         Args:
             article_id (int): The ID of the article.
             search_str (str): The search string.
         """
-        with open(f"{self.archivepath}/{article_id}.meta", 'a') as fp:
-            fp.write(f"\n - {search_str}")
+        self.writeMeta(
+            "INSERT OR IGNORE INTO found_by(pmid, search_str) VALUES(?, ?)",
+            (article_id, search_str)
+        )
+
+    def writeMeta(self, statement: str, values: tuple) -> None:
+        """
+        Executes a write on the archive database. Writes are committed
+        in transactions of commit_every statements.
+
+        Args:
+            statement (str): The SQL statement.
+            values (tuple): The values bound to the statement.
+        """
+        self.connect().execute(statement, values)
+        self._pending += 1
+        if self._pending >= self.commit_every:
+            self.commitMeta()
+
+    def commitMeta(self) -> None:
+        """
+        Commits pending writes to the archive database. Abstracts are
+        flushed first, so a committed article always has its abstract.
+        """
+        if self._text_fp is not None:
+            self._text_fp.flush()
+            self._index_fp.flush()
+        self.connect().commit()
+        self._pending = 0
+
+    def close(self) -> None:
+        """
+        Commits pending writes and closes the archive database and files.
+        They are reopened when the archive is used again.
+        """
+        if self._db is not None:
+            self.commitMeta()
+            self._db.close()
+            self._db = None
+        if self._text_fp is not None:
+            self._text_fp.close()
+            self._index_fp.close()
+            self._text_fp = None
+            self._index_fp = None
+
+    def __enter__(self) -> 'PubMedCrawler':
+        """
+        Returns the crawler for use as a context manager.
+        """
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        """
+        Closes the archive files when leaving the context.
+        """
+        self.close()
 
     def save(self, file_name: str) -> None:
         """
@@ -153,17 +376,14 @@ class PubMedCrawler:
         Returns:
             None
         """
-        child_vars = []
-        for var in dir(self):
-            ref = getattr(self, var)
-            if "__" in var or isinstance(ref, callable()):
-                continue
-            child_vars.append(var)
-
+        if self._db is not None:
+            self.commitMeta()
+        state = {
+            var: value for var, value in self.__dict__.items()
+            if var not in self.transient_vars
+        }
         with open(file_name, 'wb') as fp:
-            dill.dump(child_vars, fp)
-            for var in child_vars:
-                dill.dump(getattr(self, var), fp)
+            pickle.dump(state, fp, protocol=pickle.HIGHEST_PROTOCOL)
 
     @staticmethod
     def load(file_name: str) -> 'PubMedCrawler':
@@ -174,12 +394,11 @@ class PubMedCrawler:
             file_name (str): The name of the file to load the state from.
 
         Returns:
-            WikiCrawler: The loaded instance of the WikiCrawler.
+            PubMedCrawler: The loaded instance of the PubMedCrawler.
         """
-        empty = PubMedCrawler()
         with open(file_name, 'rb') as fp:
-            child_vars = dill.load(fp)
-            for var in child_vars:
-                loaded = dill.load(fp)
-                setattr(empty, var, loaded)
-        return empty
+            state = pickle.load(fp)
+        crawler = PubMedCrawler(state.get('archivepath'),
+                                **state.get('client_args', {}))
+        crawler.__dict__.update(state)
+        return crawler
@@ -6,17 +6,33 @@ This API defines the interface to PubMED.
 
 Author: Lorenz Hexemer
 """
+import threading
+from collections import OrderedDict, deque
+from concurrent.futures import Future, ThreadPoolExecutor
 from typing import List, Generator, Optional
-from bs4 import BeautifulSoup as html
 import requests as http
 
 from .PubMedArticle import PubMedArticle
+from .PubMedClient import PubMedClient, EUTILS_URL
 
 
 class PubMedSearch:
+    page_size = 200
+    # cache validators and results of answered queries, shared between
+    # searches so that repeated polls (e.g. get_latest) can be revalidated;
+    # least recently used first and bounded to etag_cache_size entries
+    etag_cache_size = 256
+    _etag_cache = OrderedDict()
+    _etag_lock = threading.Lock()
+
     def __init__(self, search_str: Optional[str] = None,
                  not_older_than: Optional[str] = None,
-                 abstract_available: bool = True
+                 abstract_available: bool = True,
+                 session: Optional[http.Session] = None,
+                 api_key: Optional[str] = None,
+                 tool: Optional[str] = None,
+                 email: Optional[str] = None,
+                 client: Optional[PubMedClient] = None
                  ) -> None:
         """
         Initializes a PubMedSearch object.
@@ -25,7 +41,18 @@ class PubMedSearch:
             search_str: The search query string.
             not_older_than: Filters articles not older than specified time.
             abstract_available: Whether to filter for articles with abstracts.
+            session: The session used for requests, e.g. a cached session.
+                Defaults to a new requests session.
+            api_key: NCBI API key, raises the rate limit from 3 to 10
+                requests per second.
+            tool: Name of the application reported to NCBI.
+            email: Contact address reported to NCBI.
+            client: The client used for requests. If given, session,
+                api_key, tool and email are taken from it instead.
         """
+        if client is None:
+            client = PubMedClient(session, api_key, tool, email)
+        self.client = client
         if search_str is not None:
             query = self.buildQuery(
                 search_str, not_older_than, abstract_available
@@ -37,16 +64,17 @@ class PubMedSearch:
         Starts a search defined by query from the first page of results ()
 
         Args:
-            query (str): Full pubmed http query
+            query (str): Full ESearch http query
         """
-        self.results_page = 1
-        doc = self.sendQuery(query)
+        self.query = query
+        result = self.sendQuery(query)
 
-        results = doc.find('div', class_="results-amount")
-        self.n_results = int(results.h3.span.text.replace(',', ''))
+        self.n_results = int(result['count'])
+        self.page_size = int(result['retmax']) or self.page_size
         print(f"found {self.n_results} articles.")
 
-        self.articles = self.extractResults(doc)
+        self.pmids = self.extractResults(result)
+        self._filled = len(self.pmids)
 
     def buildQuery(self,
                    search_str: str,
@@ -65,80 +93,208 @@ class PubMedSearch:
             The search query URL.
         """
         self.search_str = search_str
+        term = self.search_str
+        if abstract_available:
+            term += "+AND+hasabstract"
+
         self.query = (
-            f'https://pubmed.ncbi.nlm.nih.gov/'
-            f'?term={self.search_str}'
+            f'{EUTILS_URL}/esearch.fcgi?db=pubmed&retmode=json'
+            f'&retmax={self.page_size}&term={term}'
         )
         if not_older_than:
             if not_older_than == "1_year":
-                self.query += "&filter=datesearch.y_1"
+                self.query += "&datetype=pdat&reldate=365"
             elif not_older_than == "5_years":
-                self.query += "&filter=datesearch.y_5"
+                self.query += "&datetype=pdat&reldate=1826"
             elif not_older_than == "10_years":
-                self.query += "&filter=datesearch.y_10"
+                self.query += "&datetype=pdat&reldate=3652"
             else:
                 raise Exception(f'Invalid search flag "{not_older_than}"')
 
-        if abstract_available:
-            self.query += "&filter=simsearch1.fha"
-
         return self.query
 
-    def grepMoreResults(self) -> None:
+    def grepMoreResults(self, until: Optional[int] = None) -> None:
         """
-        Fetches more results from the PubMed website.
+        Fetches the next page of results from ESearch. If until is given,
+        all pages up to that result are fetched concurrently. self.pmids
+        is grown once to hold all fetched pages and each page is written
+        to its slot; self._filled counts the contiguously loaded IDs.
+
+        Args:
+            until: Index of the last result to fetch.
         """
-        self.results_page += 1
-        doc = self.sendQuery(self.query)
-        self.articles += self.extractResults(doc)
+        at = self._filled
+        starts = range(at, max(until or 0, at + 1), self.page_size)
+        size = min(self.n_results, starts[-1] + self.page_size)
+        if len(self.pmids) < size:
+            self.pmids += [None] * (size - len(self.pmids))
+
+        pool = ThreadPoolExecutor(self.client.max_workers)
+        try:
+            queries = [self.query] * len(starts)
+            results = pool.map(self.sendQuery, queries, starts)
+            for start, result in zip(starts, results):
+                pmids = self.extractResults(result)[:len(self.pmids) - start]
+                self.pmids[start:start + len(pmids)] = pmids
+                if start == self._filled:
+                    self._filled += len(pmids)
+        finally:
+            pool.shutdown(cancel_futures=True)
 
-    def sendQuery(self, query: str) -> None:
+    def sendQuery(self, query: str, results_start: int = 0) -> dict:
         """
-        Sends the initial query for the current page (from self.results_page)
+        Sends the query for the page starting at results_start. If the
+        page was fetched before, it is revalidated with its ETag and
+        Last-Modified date and reused when the server answers 304.
 
         Args:
-            query: full http query to pubmed
+            query: full ESearch http query
+            results_start: Index of the first result of the page.
 
         Returns
-            Parsed BeatutiflSoup document.
+            The 'esearchresult' part of the JSON response.
         """
-        query += f'&page={self.results_page}'
-        response = http.get(query)
-        doc = html(response.text, "html.parser")
-        return doc
+        query += f'&retstart={results_start}'
+        # a caching session (e.g. requests_cache) must not answer from its
+        # store, the server has to see the conditional request
+        headers = {'Cache-Control': 'no-cache'}
+        with self._etag_lock:
+            cached = self._etag_cache.get(query)
+            if cached is not None:
+                self._etag_cache.move_to_end(query)
+        if cached is not None:
+            etag, modified, _ = cached
+            if etag:
+                headers['If-None-Match'] = etag
+            if modified:
+                headers['If-Modified-Since'] = modified
+
+        response = self.client.sendRequest('GET', query,
+                                           params=self.client.params,
+                                           headers=headers)
+        if cached is not None and response.status_code == 304:
+            return cached[2]
 
-    def extractResults(self, doc) -> List:
+        result = response.json()['esearchresult']
+        etag = response.headers.get('ETag')
+        modified = response.headers.get('Last-Modified')
+        if etag or modified:
+            with self._etag_lock:
+                self._etag_cache[query] = (etag, modified, result)
+                self._etag_cache.move_to_end(query)
+                while len(self._etag_cache) > self.etag_cache_size:
+                    self._etag_cache.popitem(last=False)
+        return result
+
+    def extractResults(self, result: dict) -> List:
         """
-        Extracts search results from the given document.
+        Extracts search results from the given ESearch result.
 
         Args:
-            doc: Document to extract results from.
+            result: ESearch result to extract PubMed IDs from.
 
         Returns:
-            List of extracted articles.
-        """
-        page_links = doc.find_all('a', class_="docsum-title")
-        pubmed_ids = [p.attrs['data-article-id'] for p in page_links]
-        titles = [p.text for p in page_links]
-        docsum_autorhs = doc.find_all('span', class_="docsum-authors")
-        authors_long = [s.text for s in docsum_autorhs[::2]]
-        authors_short = [s.text for s in docsum_autorhs[1::2]]
-        citations = [
-            c.text
-            for c in doc.find_all('span', class_="docsum-journal-citation")
-        ]
-
-        results = [
-            PubMedArticle(*args)
-            for args in zip(
-                pubmed_ids,
-                titles,
-                authors_long,
-                authors_short,
-                citations
-            )
-        ]
-        return results
+            List of extracted PubMed IDs.
+        """
+        return list(result['idlist'])
+
+    def fetch_details(self,
+                      pmids: List[str],
+                      batch_size: int = 200
+                      ) -> Generator:
+        """
+        Loads the given articles from EFetch in batches of batch_size IDs.
+        While one batch is parsed, at most max_workers further batches
+        are requested in the background, so memory does not grow with
+        the number of IDs.
+
+        Args:
+            pmids: PubMed IDs of the articles to load.
+            batch_size: Maximum number of IDs sent per EFetch request.
+
+        Yields:
+            Loaded articles.
+        """
+        pool = ThreadPoolExecutor(self.client.max_workers)
+        pending = deque()
+        try:
+            for at in range(0, len(pmids), batch_size):
+                if len(pending) == self.client.max_workers:
+                    yield from self.readBatch(pending.popleft().result())
+                pending.append(pool.submit(
+                    self.requestBatch, pmids[at:at + batch_size]
+                ))
+            while pending:
+                yield from self.readBatch(pending.popleft().result())
+        finally:
+            for future in pending:
+                future.cancel()
+                future.add_done_callback(_close_response)
+            pool.shutdown(cancel_futures=True)
+
+    def requestBatch(self, pmids: List[str]) -> http.Response:
+        """
+        Sends a single EFetch request for the given articles. The body
+        of the response is not read yet.
+
+        Args:
+            pmids: PubMed IDs of the articles to load.
+
+        Returns:
+            The streamed response.
+        """
+        response = self.client.sendRequest(
+            'POST',
+            f'{EUTILS_URL}/efetch.fcgi',
+            data={'db': 'pubmed', 'retmode': 'xml', 'id': ','.join(pmids),
+                  **self.client.params},
+            stream=True
+        )
+        response.raw.decode_content = True
+        return response
+
+    def readBatch(self, response: http.Response) -> Generator:
+        """
+        Parses the articles of a streamed EFetch response one at a time
+        and closes the response afterwards.
+
+        Args:
+            response: The response returned by requestBatch.
+
+        Yields:
+            Loaded articles.
+        """
+        with response:
+            for elem in PubMedArticle.iterXml(response.raw):
+                yield PubMedArticle.fromXml(elem, self.client)
+
+    def scan_ids(self,
+                 limit: int = 100,
+                 chunk_size: Optional[int] = None
+                 ) -> Generator:
+        """
+        Yields the PubMed IDs of the search results in chunks.
+
+        Args:
+            limit: Maximum number of IDs to yield.
+            chunk_size: Maximum number of IDs per chunk. Defaults to
+                the ESearch page size.
+
+        Yields:
+            Lists of PubMed IDs.
+        """
+        chunk_size = chunk_size or self.page_size
+        end = min(self.n_results, limit)
+        at = 0
+        while at < end:
+            if at == self._filled:
+                self.grepMoreResults(end)
+                if at == self._filled:
+                    break
+
+            chunk = self.pmids[at:min(end, self._filled, at + chunk_size)]
+            at += len(chunk)
+            yield chunk
 
     def scan_results(self, limit: int = 100) -> Generator:
         """
@@ -148,12 +304,15 @@ class PubMedSearch:
             limit: Maximum number of articles to yield.
 
         Yields:
-            Articles from the search results.
+            Loaded articles from the search results.
         """
-        for at in range(self.n_results):
-            if at == limit:
-                break
+        for pmids in self.scan_ids(limit):
+            yield from self.fetch_details(pmids)
+
 
-            if at == len(self.articles):
-                self.grepMoreResults()
-            yield self.articles[at]
+def _close_response(future: Future) -> None:
+    """
+    Closes the response of a batch request that was never read.
+    """
+    if not future.cancelled() and future.exception() is None:
+        future.result().close()
@@ -1,5 +1,8 @@
 import datetime
+from typing import Optional
+import requests as http
 
+from .PubMedClient import PubMedClient, EUTILS_URL
 from .PubMedArticle import PubMedArticle
 from .PubMedSearch import PubMedSearch
 from .PubMedCrawler import PubMedCrawler
@@ -10,17 +13,18 @@ def search(search_str: str, **kwargs) -> PubMedSearch:
     return results
 
 
-def get_latest() -> PubMedSearch:
+def get_latest(session: Optional[http.Session] = None,
+               **kwargs) -> PubMedSearch:
     today = datetime.datetime.now()
     today_str = today.strftime("%Y/%m/%d").replace('/', '%2F')
     tomorow = today + datetime.timedelta(days=1)
     tomorow_str = tomorow.strftime("%Y/%m/%d").replace('/', '%2F')
     query = (
-        f"https://pubmed.ncbi.nlm.nih.gov/"
-        f"?term={today_str}%5Bedat%5D"
-        f"&filter=dates.{today_str}-{tomorow_str}"
-        f"&sort=date&size=100"
+        f"{EUTILS_URL}/esearch.fcgi?db=pubmed&retmode=json"
+        f"&term={today_str}%5Bedat%5D"
+        f"&datetype=edat&mindate={today_str}&maxdate={tomorow_str}"
+        f"&retmax=100"
     )
-    results = PubMedSearch()
+    results = PubMedSearch(session=session, **kwargs)
     results.startFromQuery(query)
     return results